@@ -1,16 +1,26 @@
 """
 Connection utilities
 """
+import contextlib
 import paramiko
 import os
 import logging
 
+import gevent.lock
+
 from teuthology.config import config
 from teuthology.contextutil import safe_while
 from paramiko.hostkeys import HostKeyEntry
 
 log = logging.getLogger(__name__)
 
+# Idle SSH connections available for reuse, keyed by the arguments they
+# were created with. Bounded per key so a burst of parallel commands
+# cannot leak an unbounded number of transports.
+MAX_POOLED_CLIENTS = 4
+_client_pool = dict()
+_client_pool_lock = gevent.lock.BoundedSemaphore()
+
 
 def split_user(user_at_host):
     """
@@ -36,6 +46,63 @@ def create_key(keytype, key):
     return ke.key
 
 
+def _pool_key(user_at_host, connect_kwargs):
+    """
+    Build a hashable pool key from connect() arguments.
+    """
+    items = []
+    for name, value in sorted(connect_kwargs.items()):
+        if isinstance(value, list):
+            value = tuple(value)
+        items.append((name, value))
+    return (user_at_host,) + tuple(items)
+
+
+@contextlib.contextmanager
+def acquire_client(user_at_host, **connect_kwargs):
+    """
+    Borrow an SSH connection from a process-wide pool, creating it via
+    connect() on a pool miss.
+
+    Repeatedly paying the SSH handshake dominates wall time when many
+    short commands are run against the same host; reusing an existing
+    transport avoids it. Connections are checked for liveness before
+    being handed out and are returned to the pool on exit, unless the
+    pool for that host is already full.
+
+    Usage:
+        with acquire_client('ubuntu@somehost') as ssh:
+            ...
+
+    :param user_at_host:   user@host, as for connect()
+    :param connect_kwargs: additional keyword arguments for connect()
+    """
+    key = _pool_key(user_at_host, connect_kwargs)
+    ssh = None
+    with _client_pool_lock:
+        idle = _client_pool.get(key, [])
+        while idle:
+            candidate = idle.pop()
+            transport = candidate.get_transport()
+            if transport is not None and transport.is_active():
+                ssh = candidate
+                break
+            candidate.close()
+    if ssh is None:
+        ssh = connect(user_at_host, **connect_kwargs)
+    try:
+        yield ssh
+    finally:
+        transport = ssh.get_transport()
+        with _client_pool_lock:
+            idle = _client_pool.setdefault(key, [])
+            if transport is not None and transport.is_active() and \
+                    len(idle) < MAX_POOLED_CLIENTS:
+                idle.append(ssh)
+            else:
+                ssh.close()
+
+
 def connect(user_at_host, host_key=None, keep_alive=False, timeout=60,
             _SSHClient=None, _create_key=None, retry=True, key_filename=None):
     """
@@ -2,23 +2,32 @@
 Paramiko run support
 """
 
+import codecs
 import io
 
 from paramiko import ChannelFile
 
 import gevent
 import gevent.event
+import gevent.pool
+import os
+import re
 import socket
-import pipes
+import shlex
 import logging
-import shutil
 
-from teuthology.contextutil import safe_while
 from teuthology.exceptions import (CommandCrashedError, CommandFailedError,
-                                   ConnectionLostError)
+                                   ConnectionLostError, MaxWhileTries)
 
 log = logging.getLogger(__name__)
 
+# Shared pool for the stream-copy greenlets spawned per process. A wide
+# parallel fan-out would otherwise create three fresh greenlets per
+# command; a bounded pool amortizes greenlet startup and keeps the hub
+# from being swamped.
+IO_POOL_SIZE = 512
+_io_pool = gevent.pool.Pool(size=IO_POOL_SIZE)
+
 
 class RemoteProcess(object):
     """
@@ -31,6 +40,8 @@ class RemoteProcess(object):
         'returncode', 'exitstatus', 'timeout',
         'greenlets',
         '_wait', 'logger',
+        '_stdout_logger', '_stderr_logger',
+        '_deferred_drain',
         # for orchestra.remote.Remote to place a backreference
         'remote',
         'label',
@@ -72,8 +83,10 @@ class RemoteProcess(object):
 
         self.check_status = check_status
         self.label = label
-        if timeout:
-            self.timeout = timeout
+        # Initialize every slot: reading an unset slot raises
+        # AttributeError, which makes hasattr()-style probing needlessly
+        # expensive on hot paths
+        self.timeout = timeout or None
         if hostname:
             self.hostname = hostname
         else:
@@ -82,17 +95,24 @@ class RemoteProcess(object):
         self.greenlets = []
         self.stdin, self.stdout, self.stderr = (None, None, None)
         self.returncode = self.exitstatus = None
+        self._deferred_drain = None
         self._wait = wait
         self.logger = logger or log
+        # Logger lookups walk the logging manager's dict under its global
+        # lock; do them once per process rather than once per stream setup
+        host_log = self.logger.getChild(self.hostname)
+        self._stdout_logger = host_log.getChild('stdout')
+        self._stderr_logger = host_log.getChild('stderr')
 
     def execute(self):
         """
         Execute remote command
         """
+        host_log = log.getChild(self.hostname)
         for line in self.command.split('\n'):
-            log.getChild(self.hostname).debug('%s> %s' % (self.label or '', line))
+            host_log.debug('%s> %s' % (self.label or '', line))
 
-        if hasattr(self, 'timeout'):
+        if self.timeout is not None:
             (self._stdin_buf, self._stdout_buf, self._stderr_buf) = \
                 self.client.exec_command(self.command, timeout=self.timeout)
         else:
@@ -100,14 +120,29 @@ class RemoteProcess(object):
                 self.client.exec_command(self.command)
         (self.stdin, self.stdout, self.stderr) = \
             (self._stdin_buf, self._stdout_buf, self._stderr_buf)
+        # Buffer reads from the real channel so consumers pull 64 KiB at
+        # a time off the transport instead of paramiko's small chunks
+        if isinstance(self._stdout_buf, ChannelFile):
+            self.stdout = io.BufferedReader(
+                _RawChannelAdapter(self._stdout_buf),
+                buffer_size=COPY_CHUNK_SIZE)
+        if isinstance(self._stderr_buf, ChannelFile):
+            self.stderr = io.BufferedReader(
+                _RawChannelAdapter(self._stderr_buf),
+                buffer_size=COPY_CHUNK_SIZE)
 
     def add_greenlet(self, greenlet):
         self.greenlets.append(greenlet)
 
     def setup_stdin(self, stream_obj):
         self.stdin = KludgeFile(wrapped=self.stdin)
-        if stream_obj is not PIPE:
-            greenlet = gevent.spawn(copy_and_close, stream_obj, self.stdin)
+        if stream_obj is None:
+            # Nothing to feed; signal EOF right here instead of spawning
+            # a greenlet whose only job is to close the stream
+            self.stdin.close()
+            self.stdin = None
+        elif stream_obj is not PIPE:
+            greenlet = _io_pool.spawn(copy_and_close, stream_obj, self.stdin)
             self.add_greenlet(greenlet)
             self.stdin = None
         elif self._wait:
@@ -117,10 +152,9 @@ class RemoteProcess(object):
     def setup_output_stream(self, stream_obj, stream_name, quiet=False):
         if stream_obj is not PIPE:
             # Log the stream
-            host_log = self.logger.getChild(self.hostname)
-            stream_log = host_log.getChild(stream_name)
+            stream_log = getattr(self, '_%s_logger' % stream_name)
             self.add_greenlet(
-                gevent.spawn(
+                _io_pool.spawn(
                     copy_file_to,
                     getattr(self, stream_name),
                     stream_log,
@@ -133,12 +167,39 @@ class RemoteProcess(object):
             # FIXME: Is this actually true?
             raise RuntimeError(self.deadlock_warning % stream_name)
 
+    def defer_output_drain(self, quiet=False):
+        """
+        Arrange for stdout and stderr to be drained inline by wait()
+        rather than by dedicated copy greenlets.  Only valid when wait()
+        is called promptly; the channel would otherwise fill up and
+        stall the remote command.
+        """
+        self._deferred_drain = quiet
+
     def wait(self):
         """
         Block until remote process finishes.
 
         :returns: self.returncode
         """
+        if self._deferred_drain is not None:
+            quiet = self._deferred_drain
+            self._deferred_drain = None
+            # Drain stderr from a pooled greenlet while this greenlet
+            # consumes stdout: one spawn per command instead of two
+            stderr_greenlet = _io_pool.spawn(
+                copy_file_to, self.stderr, self._stderr_logger, None, quiet)
+            try:
+                copy_to_log(self.stdout, self._stdout_logger, quiet=quiet)
+                stderr_greenlet.get()
+            finally:
+                # If the stdout drain raised, don't abandon the stderr
+                # greenlet: it would hold a pool slot and dump its own
+                # failure asynchronously.  kill() is a no-op if it
+                # already finished.
+                stderr_greenlet.kill(block=False)
+                self.stdout = None
+                self.stderr = None
 
         status = self._get_exitstatus()
         if status != 0:
@@ -150,12 +211,13 @@ class RemoteProcess(object):
                 log.debug("timed out waiting; will kill: {}".format(greenlet))
                 greenlet.kill(block=False)
         for stream in ('stdout', 'stderr'):
-            if hasattr(self, stream):
-                stream_obj = getattr(self, stream)
+            stream_obj = getattr(self, stream)
+            if stream_obj is not None:
                 # Despite ChannelFile having a seek() method, it raises
-                # "IOError: File does not support seeking."
-                if hasattr(stream_obj, 'seek') and \
-                        not isinstance(stream_obj, ChannelFile):
+                # "IOError: File does not support seeking." - it reports
+                # seekable() False, as does a BufferedReader over it.
+                if getattr(stream_obj, 'seekable', None) and \
+                        stream_obj.seekable():
                     stream_obj.seek(0)
 
         self._raise_for_status()
@@ -197,7 +259,6 @@ class RemoteProcess(object):
 
     @property
     def finished(self):
-        gevent.wait(self.greenlets, timeout=0.1)
         ready = self._stdout_buf.channel.exit_status_ready()
         if ready:
             self._get_exitstatus()
@@ -240,6 +301,11 @@ class Raw(object):
         return self.value == value
 
 
+# Characters that never need shell quoting; checking this first skips a
+# shlex.quote call for the common already-safe argument
+_SAFE = re.compile(r'[A-Za-z0-9_@%+=:,./-]+').fullmatch
+
+
 def quote(args):
     """
     Internal quote wrapper.
@@ -251,14 +317,22 @@ def quote(args):
         for a in args:
             if isinstance(a, Raw):
                 yield a.value
+            elif _SAFE(a):
+                yield a
             else:
-                yield pipes.quote(a)
+                yield shlex.quote(a)
     if isinstance(args, list):
         return ' '.join(_quote(args))
     else:
         return args
 
 
+# Chunk size for draining remote streams; iterating a ChannelFile line by
+# line devolves into byte-at-a-time channel reads, so read big chunks and
+# split lines locally instead.
+COPY_CHUNK_SIZE = 65536
+
+
 def copy_to_log(f, logger, loglevel=logging.INFO, capture=None, quiet=False):
     """
     Copy line by line from file in f to the log from logger
@@ -270,43 +344,117 @@ def copy_to_log(f, logger, loglevel=logging.INFO, capture=None, quiet=False):
     :param quiet: suppress `logger` usage if True, this is useful only
                   in combination with `capture`, defaults False
     """
-    # Work-around for http://tracker.ceph.com/issues/8313
+    # Work-around for http://tracker.ceph.com/issues/8313; the second
+    # part (decoding with 'replace', which cannot raise) lives in the
+    # type-specialized loops below
     if isinstance(f, ChannelFile):
         f._flags += ChannelFile.FLAG_BINARY
-    for line in f:
-        if capture:
-            if isinstance(capture, io.StringIO):
-                if isinstance(line, str):
-                    capture.write(line)
-                else:
-                    capture.write(line.decode('utf-8', 'replace'))
-            elif isinstance(capture, io.BytesIO):
-                if isinstance(line, str):
-                    capture.write(line.encode())
-                else:
-                    capture.write(line)
-        line = line.rstrip()
-        # Second part of work-around for http://tracker.ceph.com/issues/8313
-        if quiet:
-            continue
-        try:
-            if isinstance(line, bytes):
-                line = line.decode('utf-8', 'replace')
-            logger.log(loglevel, line)
-        except (UnicodeDecodeError, UnicodeEncodeError):
-            logger.exception("Encountered unprintable line in command output")
+
+    # Check the logger's effective level once, not per line
+    emit = not quiet and logger.isEnabledFor(loglevel)
+    if not emit and not capture:
+        # Nobody consumes the data; just drain the stream
+        while f.read(COPY_CHUNK_SIZE):
+            pass
+        return
+
+    # The stream yields either bytes or str throughout; peek at the
+    # first chunk and dispatch to a loop specialized for that type
+    # instead of re-checking per chunk and per line
+    chunk = f.read(COPY_CHUNK_SIZE)
+    if not chunk:
+        return
+    if isinstance(chunk, bytes):
+        _copy_bytes_to_log(f, chunk, logger, loglevel, capture, emit)
+    else:
+        _copy_str_to_log(f, chunk, logger, loglevel, capture, emit)
+
+
+def _copy_bytes_to_log(f, chunk, logger, loglevel, capture, emit):
+    """
+    copy_to_log inner loop for byte streams.
+    """
+    text_capture = isinstance(capture, io.StringIO)
+    byte_capture = isinstance(capture, io.BytesIO)
+    if text_capture:
+        # A multibyte UTF-8 sequence may straddle a chunk boundary, so
+        # chunks cannot be decoded independently
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    residual = b''
+    while chunk:
+        if text_capture:
+            capture.write(decoder.decode(chunk))
+        elif byte_capture:
+            capture.write(chunk)
+        if residual:
+            chunk = residual + chunk
+        lines = chunk.split(b'\n')
+        # The last piece is an incomplete line; hold it until the next
+        # chunk (or EOF) completes it
+        residual = lines.pop()
+        if emit:
+            for line in lines:
+                logger.log(loglevel, line.decode('utf-8', 'replace').rstrip())
+        chunk = f.read(COPY_CHUNK_SIZE)
+    if text_capture:
+        capture.write(decoder.decode(b'', True))
+    if residual and emit:
+        logger.log(loglevel, residual.decode('utf-8', 'replace').rstrip())
+
+
+def _copy_str_to_log(f, chunk, logger, loglevel, capture, emit):
+    """
+    copy_to_log inner loop for text streams.
+    """
+    text_capture = isinstance(capture, io.StringIO)
+    byte_capture = isinstance(capture, io.BytesIO)
+    residual = ''
+    while chunk:
+        if text_capture:
+            capture.write(chunk)
+        elif byte_capture:
+            capture.write(chunk.encode())
+        if residual:
+            chunk = residual + chunk
+        lines = chunk.split('\n')
+        # The last piece is an incomplete line; hold it until the next
+        # chunk (or EOF) completes it
+        residual = lines.pop()
+        if emit:
+            for line in lines:
+                logger.log(loglevel, line.rstrip())
+        chunk = f.read(COPY_CHUNK_SIZE)
+    if residual and emit:
+        logger.log(loglevel, residual.rstrip())
 
 
 def copy_and_close(src, fdst):
     """
-    copyfileobj call wrapper.
+    Copy all of src to fdst, then close fdst.
+
+    Deliberately avoids shutil.copyfileobj: paramiko's write path slices
+    its remaining buffer on every send, which is quadratic on large
+    inputs, so feed it O(1)-sliceable memoryview chunks instead.
     """
     if src is not None:
+        if isinstance(src, str):
+            src = src.encode()
         if isinstance(src, bytes):
-            src = io.BytesIO(src)
-        elif isinstance(src, str):
-            src = io.StringIO(src)
-        shutil.copyfileobj(src, fdst)
+            view = memoryview(src)
+            while view:
+                written = fdst.write(view)
+                if written is None:
+                    # File-API writers consume everything in one call
+                    break
+                view = view[written:]
+        else:
+            while True:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if isinstance(chunk, bytes):
+                    chunk = memoryview(chunk)
+                fdst.write(chunk)
     fdst.close()
 
 
@@ -383,6 +531,51 @@ class KludgeFile(object):
         self._wrapped.channel.shutdown_write()
 
 
+def tune_transport(transport):
+    """
+    Raise the channel window and rekey limits on a paramiko transport.
+
+    Paramiko's default 64 KiB channel window caps throughput for commands
+    that write more than a few hundred KiB to stdout/stderr, as the sender
+    stalls waiting for window updates. Opt-in via the TEUTHOLOGY_SSH_WINDOW
+    environment variable since the larger window costs memory per channel.
+    Applied at most once per transport.
+    """
+    if not os.environ.get('TEUTHOLOGY_SSH_WINDOW'):
+        return
+    if getattr(transport, '_teuthology_tuned', False):
+        return
+    transport.default_window_size = 2 ** 27
+    transport.default_max_packet_size = 2 ** 19
+    transport.packetizer.REKEY_BYTES = 2 ** 40
+    transport.packetizer.REKEY_PACKETS = 2 ** 40
+    transport._teuthology_tuned = True
+
+
+class _RawChannelAdapter(io.RawIOBase):
+    """
+    Present a paramiko ChannelFile as a raw stream so it can sit under
+    an io.BufferedReader.
+    """
+    def __init__(self, wrapped):
+        self._wrapped = wrapped
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._wrapped.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def close(self):
+        try:
+            self._wrapped.close()
+        finally:
+            super(_RawChannelAdapter, self).close()
+
+
 def run(
     client, args,
     stdin=None, stdout=None, stderr=None,
@@ -400,7 +593,7 @@ def run(
     """
     Run a command remotely.  If any of 'args' contains shell metacharacters
     that you want to pass unquoted, pass it as an instance of Raw(); otherwise
-    it will be quoted with pipes.quote() (single quote, and single quotes
+    it will be quoted with shlex.quote() (single quote, and single quotes
     enclosed in double quotes).
 
     :param client: SSHConnection to run the command with
@@ -433,6 +626,7 @@ def run(
     try:
         transport = client.get_transport()
         if transport:
+            tune_transport(transport)
             (host, port) = transport.getpeername()[0:2]
         else:
             raise ConnectionLostError(command=quote(args), node=name)
@@ -449,13 +643,30 @@ def run(
                       cwd=cwd)
     r.execute()
     r.setup_stdin(stdin)
-    r.setup_output_stream(stderr, 'stderr', quiet)
-    r.setup_output_stream(stdout, 'stdout', quiet)
-    if wait:
+    if wait and stdout is None and stderr is None:
+        # Both streams go to the default loggers and we block in wait()
+        # anyway; drain them there rather than spawning copy greenlets
+        r.defer_output_drain(quiet)
         r.wait()
+    else:
+        r.setup_output_stream(stderr, 'stderr', quiet)
+        r.setup_output_stream(stdout, 'stdout', quiet)
+        if wait:
+            r.wait()
     return r
 
 
+def _wait_quietly(proc):
+    """
+    Wait on a process, swallowing failures.  Used by wait() below, which
+    re-raises them from the caller's greenlet instead.
+    """
+    try:
+        proc.wait()
+    except Exception:
+        pass
+
+
 def wait(processes, timeout=None):
     """
     Wait for all given processes to exit.
@@ -467,13 +678,18 @@ def wait(processes, timeout=None):
     if timeout:
         log.info("waiting for %d", timeout)
     if timeout and timeout > 0:
-        with safe_while(tries=(timeout // 6)) as check_time:
-            not_ready = list(processes)
-            while len(not_ready) > 0:
-                check_time()
-                for proc in list(not_ready):
-                    if proc.finished:
-                        not_ready.remove(proc)
+        processes = list(processes)
+        # Block on real channel readiness instead of polling each
+        # process on a timer
+        greenlets = [gevent.spawn(_wait_quietly, proc) for proc in processes]
+        finished = gevent.joinall(greenlets, timeout=timeout)
+        if len(finished) < len(greenlets):
+            for greenlet in greenlets:
+                greenlet.kill(block=False)
+            raise MaxWhileTries(
+                'reached maximum tries after waiting for %s seconds' %
+                timeout
+            )
 
     for proc in processes:
         proc.wait()
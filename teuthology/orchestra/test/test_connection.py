@@ -87,6 +87,52 @@ class TestConnection(object):
         m_transport.set_keepalive.assert_called_once_with(False)
         assert got is m_ssh_instance
 
+    def test_acquire_client_reuses_live_connection(self):
+        self.clear_config()
+        connection._client_pool.clear()
+        m_ssh_instance = self.m_ssh.return_value = Mock();
+        m_transport = Mock()
+        m_transport.is_active.return_value = True
+        m_ssh_instance.get_transport.return_value = m_transport
+        with connection.acquire_client(
+            'jdoe@orchestra.test.newdream.net.invalid',
+            _SSHClient=self.m_ssh,
+        ) as first:
+            pass
+        with connection.acquire_client(
+            'jdoe@orchestra.test.newdream.net.invalid',
+            _SSHClient=self.m_ssh,
+        ) as second:
+            pass
+        assert second is first
+        m_ssh_instance.connect.assert_called_once()
+        assert not m_ssh_instance.close.called
+
+    def test_acquire_client_discards_dead_connection(self):
+        self.clear_config()
+        connection._client_pool.clear()
+        m_ssh_instance = self.m_ssh.return_value = Mock();
+        m_transport = Mock()
+        m_transport.is_active.return_value = True
+        m_ssh_instance.get_transport.return_value = m_transport
+        with connection.acquire_client(
+            'jdoe@orchestra.test.newdream.net.invalid',
+            _SSHClient=self.m_ssh,
+        ):
+            pass
+        m_transport.is_active.return_value = False
+        m_new_instance = self.m_ssh.return_value = Mock()
+        m_new_transport = Mock()
+        m_new_transport.is_active.return_value = True
+        m_new_instance.get_transport.return_value = m_new_transport
+        with connection.acquire_client(
+            'jdoe@orchestra.test.newdream.net.invalid',
+            _SSHClient=self.m_ssh,
+        ) as second:
+            pass
+        m_ssh_instance.close.assert_called_once()
+        assert second is m_new_instance
+
     def test_connect_override_hostkeys(self):
         self.clear_config()
         m_ssh_instance = self.m_ssh.return_value = Mock();
@@ -1,4 +1,4 @@
-from io import BytesIO
+from io import BytesIO, StringIO
 
 import paramiko
 import socket
@@ -264,6 +264,67 @@ class TestRun(object):
         run.copy_and_close(b'', MagicMock())
 
 
+class TestCopyToLog(object):
+    def make_logger(self):
+        m_logger = MagicMock()
+        m_logger.isEnabledFor.return_value = True
+        return m_logger
+
+    def logged_lines(self, m_logger):
+        return [call[0][1] for call in m_logger.log.call_args_list]
+
+    def test_trailing_partial_line(self):
+        m_logger = self.make_logger()
+        run.copy_to_log(BytesIO(b'one\ntwo'), m_logger)
+        assert self.logged_lines(m_logger) == ['one', 'two']
+
+    def test_lines_span_chunks(self):
+        m_logger = self.make_logger()
+        with patch.object(run, 'COPY_CHUNK_SIZE', 4):
+            run.copy_to_log(BytesIO(b'abcdefgh\nij\n'), m_logger)
+        assert self.logged_lines(m_logger) == ['abcdefgh', 'ij']
+
+    def test_capture_stringio(self):
+        m_logger = self.make_logger()
+        capture = StringIO()
+        run.copy_to_log(BytesIO(b'foo\nbar\n'), m_logger, capture=capture)
+        assert capture.getvalue() == 'foo\nbar\n'
+        assert self.logged_lines(m_logger) == ['foo', 'bar']
+
+    def test_capture_bytesio(self):
+        m_logger = self.make_logger()
+        capture = BytesIO()
+        run.copy_to_log(BytesIO(b'foo\nbar'), m_logger, capture=capture)
+        assert capture.getvalue() == b'foo\nbar'
+
+    def test_str_stream(self):
+        m_logger = self.make_logger()
+        capture = BytesIO()
+        run.copy_to_log(StringIO('foo\nbar\n'), m_logger, capture=capture)
+        assert capture.getvalue() == b'foo\nbar\n'
+        assert self.logged_lines(m_logger) == ['foo', 'bar']
+
+    def test_quiet_with_capture(self):
+        m_logger = self.make_logger()
+        capture = BytesIO()
+        run.copy_to_log(
+            BytesIO(b'foo\nbar\n'), m_logger, capture=capture, quiet=True)
+        assert capture.getvalue() == b'foo\nbar\n'
+        assert not m_logger.log.called
+
+    def test_multibyte_spans_chunks(self):
+        # A multibyte UTF-8 sequence straddling a chunk boundary must
+        # not be decoded into replacement characters
+        m_logger = self.make_logger()
+        capture = StringIO()
+        data = 'abcé\nfoé\n'.encode()
+        assert data[3:5] == 'é'.encode()
+        with patch.object(run, 'COPY_CHUNK_SIZE', 4):
+            run.copy_to_log(BytesIO(data), m_logger, capture=capture)
+        assert capture.getvalue() == 'abcé\nfoé\n'
+        assert self.logged_lines(m_logger) == ['abcé', 'foé']
+
+
 class TestQuote(object):
     def test_quote_simple(self):
         got = run.quote(['a b', ' c', 'd e '])